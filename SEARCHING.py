@@ -1,16 +1,23 @@
 import streamlit as st
 import pandas as pd
+import numpy as np
 import json
 import os
+import hashlib
 from rapidfuzz import process, fuzz
-import folium
-from streamlit_folium import st_folium
 from geopy.geocoders import Nominatim
 import time
+import asyncio
+import sqlite3
+import re
+import zlib
+import string
+import html
+from types import MappingProxyType
 
 # --- 1. 基础设置与依赖检查 ---
 try:
-    from openai import OpenAI
+    from openai import OpenAI, AsyncOpenAI, BadRequestError
     HAS_OPENAI = True
 except ImportError:
     HAS_OPENAI = False
@@ -21,6 +28,188 @@ try:
 except ImportError:
     HAS_OPENPYXL = False
 
+try:
+    import aiohttp  # noqa: F401  (geopy AioHTTPAdapter 异步批量 geocode 需要)
+    from geopy.adapters import AioHTTPAdapter
+    HAS_AIOHTTP = True
+except ImportError:
+    HAS_AIOHTTP = False
+
+try:
+    import faiss
+    from sentence_transformers import SentenceTransformer
+    HAS_SEMANTIC = True
+except ImportError:
+    HAS_SEMANTIC = False
+
+try:
+    import pydeck as pdk  # 随 streamlit 分发；WebGL 渲染标记，前端开销远小于 Leaflet 重挂载
+    HAS_PYDECK = True
+except ImportError:
+    HAS_PYDECK = False
+
+# 新加坡邻近区域映射 (基于实际地理位置)
+_NEARBY_AREAS = {
+    'bedok': ['tampines', 'pasir ris', 'changi'],
+    'tampines': ['bedok', 'pasir ris', 'sengkang'],
+    'yishun': ['woodlands', 'sembawang', 'ang mo kio'],
+    'woodlands': ['yishun', 'sembawang', 'choa chu kang'],
+    'jurong west': ['jurong east', 'choa chu kang', 'bukit batok'],
+    'sengkang': ['punggol', 'tampines', 'serangoon'],
+    'punggol': ['sengkang', 'tampines', 'serangoon'],
+    'ang mo kio': ['yishun', 'serangoon', 'bishan'],
+    'serangoon': ['ang mo kio', 'sengkang', 'bishan']
+}
+# 预构造成单个正则交替式：所有邻近区域一次扫描完成
+# (Arrow 后端的 str.contains 不接受 re.Pattern，因此存模式字符串而非编译对象)
+_NEARBY_PATTERNS = {k: '|'.join(map(re.escape, v)) for k, v in _NEARBY_AREAS.items()}
+
+# 地图标记的区域 fallback 坐标：模块级常量，避免每个标记循环里重建字典
+# (MappingProxyType 只读视图，防止运行期被意外改写)
+_AREA_FALLBACK_COORDS = MappingProxyType({
+    'Bedok': (1.324, 103.930),
+    'Tampines': (1.345, 103.944),
+    'Jurong West': (1.347, 103.717),
+    'Woodlands': (1.437, 103.786),
+    'Yishun': (1.429, 103.835),
+    'Ang Mo Kio': (1.375, 103.845),
+    'Hougang': (1.361, 103.886),
+    'Sengkang': (1.391, 103.895),
+    'Punggol': (1.405, 103.902),
+    'Serangoon': (1.357, 103.874),
+    'Bukit Batok': (1.358, 103.754),
+    'Pasir Ris': (1.372, 103.949),
+    'Toa Payoh': (1.334, 103.848),
+    'Bishan': (1.351, 103.848),
+    'Kallang': (1.311, 103.862),
+})
+
+# 特定邮政编码的精确坐标（Jurong West 一带 geocoder 命中率差，人工校准）
+_PRECISE_POSTAL_COORDS = MappingProxyType({
+    '640526': (1.3486, 103.7065),  # Jurong West Street 61
+    # '641652': 移除特殊坐标，让它使用普通geocoding获得正确位置
+    '640652': (1.3500, 103.7070),  # Jurong West Street 65
+    '640650': (1.3495, 103.7068),  # Jurong West Street 65 附近
+    '640651': (1.3498, 103.7069),  # Jurong West Street 65 附近
+    '641650': (1.3390, 103.7120),  # Jurong West Street 64 附近
+    '641651': (1.3392, 103.7122),  # Jurong West Street 64 附近
+    '641653': (1.3398, 103.7128),  # Jurong West Street 64 附近
+})
+
+# geocoder 全部失败时按区域名兜底的坐标（与 _AREA_FALLBACK_COORDS 口径略有差异，保持原值）
+_GEOCODE_AREA_COORDS = MappingProxyType({
+    'Jurong West': (1.347, 103.717),  # 更新为更准确的坐标
+    'Bedok': (1.324, 103.930),
+    'Tampines': (1.345, 103.944),
+    'Yishun': (1.429, 103.835),
+    'Woodlands': (1.437, 103.786),
+    'Ang Mo Kio': (1.375, 103.845),
+    'Sengkang': (1.391, 103.895),
+    'Punggol': (1.405, 103.902),
+    'Serangoon': (1.357, 103.874),
+    'Bukit Batok': (1.358, 103.754),
+    'Bukit Merah': (1.277, 103.823),
+    'Clementi': (1.315, 103.760),
+    'Hougang': (1.371, 103.886),
+    'Pasir Ris': (1.372, 103.949),
+    'Toa Payoh': (1.334, 103.856),
+})
+
+# 结果卡片地址清理：只有去 HTML 标签需要正则；空白归一交给 C 实现的
+# str.split/join（split 本身把换行/制表当分隔符，不必再查表替换）
+_HTML_TAG_RE = re.compile(r'<[^>]*>')
+
+# 诊所标记弹窗模板：模块级解析一次，循环内只做占位替换（字段在替换时统一转义）
+_POPUP_TMPL = string.Template("""
+<div style='font-family: Arial, sans-serif; width: 250px;'>
+    <h4 style='margin: 0 0 10px 0; color: #2E8B57;'>🏥 $name</h4>
+    <p style='margin: 5px 0;'><strong>📍 区域:</strong> $area</p>
+    <p style='margin: 5px 0;'><strong>🏠 地址:</strong> $address</p>
+    <p style='margin: 5px 0;'><strong>📞 电话:</strong> $contact</p>
+    $distance_row
+</div>
+""")
+
+# 查询位置标记的区域坐标（与 fallback 坐标一致）
+_QUERY_AREA_COORDS = MappingProxyType({
+    'Jurong West': (1.347, 103.717),  # 更新为更准确的坐标
+    'Bedok': (1.324, 103.930),
+    'Tampines': (1.345, 103.944),
+    'Yishun': (1.429, 103.835),
+    'Woodlands': (1.437, 103.786),
+    'Ang Mo Kio': (1.375, 103.845),
+    'Sengkang': (1.391, 103.895),
+    'Punggol': (1.405, 103.902),
+    'Serangoon': (1.357, 103.874),
+    'Bukit Batok': (1.358, 103.754),
+    'Pasir Ris': (1.372, 103.949),
+})
+
+# 坐标落盘缓存：st.cache_data 的 TTL 过期或应用重启后不必重打 Nominatim
+# (其政策限速 1 req/s 且明确鼓励客户端缓存)
+_COORD_DB = sqlite3.connect('.coord_cache.db', check_same_thread=False)
+_COORD_DB.execute('CREATE TABLE IF NOT EXISTS coords(k TEXT PRIMARY KEY, lat REAL, lng REAL)')
+_COORD_DB.commit()
+
+
+def _coord_cache_key(address, area=None):
+    """坐标缓存键：空白折叠 + 小写归一，同一地址的不同写法共享缓存条目"""
+    return f"{' '.join(str(address).split()).lower()}|{str(area or '').strip().lower()}"
+
+# 持久化 geocoder：keep-alive 连接跨调用复用，省掉每次请求的 TCP+TLS 握手
+try:
+    from geopy.adapters import RequestsAdapter
+    _GEOLOCATOR = Nominatim(user_agent="medical_search_app", adapter_factory=RequestsAdapter)
+except Exception:
+    _GEOLOCATOR = Nominatim(user_agent="medical_search_app")
+
+# 同步 geocode 的限速闸：只在真正打 API 前等待，缓存命中路径零延迟。
+# 间隔取 Nominatim 政策的 1 req/s
+_GEOCODE_MIN_INTERVAL = 1.0
+_last_geocode_ts = [0.0]
+
+
+def _throttle_geocode():
+    wait = _GEOCODE_MIN_INTERVAL - (time.monotonic() - _last_geocode_ts[0])
+    if wait > 0:
+        time.sleep(wait)
+    _last_geocode_ts[0] = time.monotonic()
+
+
+async def _geocode_batch_async(addresses):
+    """批量 geocode：收益来自复用同一 aiohttp keep-alive 连接（省掉逐地址的
+    TCP+TLS 握手），请求本身串行发出，与同步闸共用时间戳，
+    严格遵守 Nominatim 1 req/s 政策"""
+    async with Nominatim(user_agent="medical_search_app", adapter_factory=AioHTTPAdapter) as geolocator:
+        results = []
+        for addr in addresses:
+            wait = _GEOCODE_MIN_INTERVAL - (time.monotonic() - _last_geocode_ts[0])
+            if wait > 0:
+                await asyncio.sleep(wait)
+            _last_geocode_ts[0] = time.monotonic()
+            try:
+                results.append(await geolocator.geocode(addr, timeout=5))
+            except Exception:
+                results.append(None)
+        return results
+
+
+def geocode_batch(addresses):
+    """一次性解析一批地址；没有 aiohttp 时退回持久化同步 geocoder 逐个请求"""
+    if HAS_AIOHTTP:
+        try:
+            return asyncio.run(_geocode_batch_async(addresses))
+        except Exception as e:
+            print(f"Async batch geocoding failed, falling back to sync: {e}")
+    results = []
+    for addr in addresses:
+        try:
+            _throttle_geocode()
+            results.append(_GEOLOCATOR.geocode(addr, timeout=5))
+        except Exception:
+            results.append(None)
+    return results
+
 st.set_page_config(
     page_title="Agentic 医疗搜索",
     page_icon="🩺",
@@ -28,7 +217,9 @@ st.set_page_config(
 )
 
 # --- 2. CSS 样式优化 ---
-st.markdown("""
+# 样式做成模块常量：字符串只构造一次。注意不能用 cache_resource 吞掉
+# st.markdown 调用本身 —— 元素不在 rerun 里重新发出的话页面样式会直接丢失。
+_CSS = """
 <style>
     .stChatMessage { background-color: #f4f6f9; border-radius: 10px; border: 1px solid #e1e4e8; }
     .result-card {
@@ -46,72 +237,370 @@ st.markdown("""
     .tag-lang { background-color: #e8f5e9; color: #2e7d32; } /* 绿色: 语言 */
     .debug-expander { background-color: #fff8e1; border: 1px dashed #ffc107; border-radius: 5px; }
 </style>
-""", unsafe_allow_html=True)
+"""
+
+
+def _inject_css():
+    st.markdown(_CSS, unsafe_allow_html=True)
+
+
+_inject_css()
+
+# --- 3. LLM 客户端与意图解析缓存 ---
+_INTENT_SYSTEM_PROMPT = """
+        You are a medical search intent analyzer.
+        Target Data:
+        1. Doctors (Fields: Name, Specialty, Languages, Services)
+        2. Clinics (Fields: Name, Address, Area)
+
+        Task: Parse user query into a JSON object.
+
+        Logic for parsing:
+        1. ***LOCATION SEARCH PRIORITY***: If query contains "nearest", "closest", "near", "around", "离...最近" patterns, set intent="find_clinic" and extract location to "Area" field.
+        2. ***NAME DETECTION***: If query contains patterns like "find dr. [name]", "doctor [name]", or specific names, extract to "keywords" field and leave "Specialty" EMPTY.
+        3. Location extraction: Singapore areas like "Bedok", "Tampines", "Yishun", "Ang Mo Kio", "Woodlands", etc. -> "Area" field
+        4. Language extraction: "Chinese", "Mandarin", "English" etc. -> "Languages" field
+        5. ***SPECIALTY FROM SYMPTOMS*** (only if NO specific name mentioned): pick the single best
+           specialty from the allowed values (enforced by the response schema). Map common symptoms
+           to "General Medicine" (NOT a GP wording), babies/children to "Family & Community Medicine".
+
+        Output fields: intent ("find_doctor" or "find_clinic"), keywords (specific person/clinic
+        name, empty for general search), filters (Specialty / Languages / Area), reasoning (brief).
+
+        Examples:
+        - "nearest clinic to Bedok" -> intent: "find_clinic", keywords: "", Area: "Bedok" (location-based clinic search)
+        - "clinics near Tampines" -> intent: "find_clinic", keywords: "", Area: "Tampines" (location-based clinic search)
+        - "clinic nearest 641652" -> intent: "find_clinic", keywords: "", Area: "641652" (postal code-based search)
+        - "i want clinic nearest 560123" -> intent: "find_clinic", keywords: "", Area: "560123" (postal code search)
+        - "find dr. low" -> intent: "find_doctor", keywords: "low", Specialty: "" (doctor name search)
+        - "find doctor smith" -> intent: "find_doctor", keywords: "smith", Specialty: "" (doctor name search)
+        - "i want jam avin" -> intent: "find_doctor", keywords: "jam avin", Specialty: "" (doctor name search)
+        - "i have fever" -> intent: "find_doctor", keywords: "", Specialty: "General Medicine" (symptom-based search)
+        - "baby sick" -> intent: "find_doctor", keywords: "", Specialty: "Family & Community Medicine" (symptom-based search)
+        """
+
+
+# 症状关键词 -> 专科 的本地映射，与提示词中的规则一致。
+# 简单查询据此短路，不必每次都付一个 LLM 往返 (~500ms -> <1ms)。
+_SYMPTOM_SPECIALTY = {
+    'fever': 'General Medicine', 'cold': 'General Medicine', 'flu': 'General Medicine',
+    'sick': 'General Medicine', 'illness': 'General Medicine',
+    'baby': 'Family & Community Medicine', 'kid': 'Family & Community Medicine',
+    'child': 'Family & Community Medicine', 'infant': 'Family & Community Medicine',
+    'emergency': 'Emergency Medicine', 'urgent': 'Emergency Medicine',
+    'heart': 'Cardiology', 'chest pain': 'Cardiology', 'cardiac': 'Cardiology',
+    'stomach': 'Gastroenterology', 'gut': 'Gastroenterology', 'digestive': 'Gastroenterology',
+    'bone': 'Orthopaedic Surgery', 'fracture': 'Orthopaedic Surgery', 'injury': 'Orthopaedic Surgery',
+    'eye': 'Ophthalmology', 'vision': 'Ophthalmology',
+    'throat': 'Otolaryngology', 'ear': 'Otolaryngology', 'nose': 'Otolaryngology',
+    'mental': 'Psychiatry', 'depression': 'Psychiatry', 'anxiety': 'Psychiatry',
+    'tooth': 'Dental', 'teeth': 'Dental', 'dentist': 'Dental',
+    'diabetes': 'Endocrinology', 'sugar': 'Endocrinology',
+    'kidney': 'Renal Medicine', 'renal': 'Renal Medicine',
+    'urine': 'Urology', 'bladder': 'Urology',
+    'breathing': 'Respiratory Medicine', 'lung': 'Respiratory Medicine',
+}
+# 关键词只有几十个，带词边界的预编译交替式与 Aho-Corasick 在此规模无差别
+_SYMPTOM_RE = re.compile(r'\b(' + '|'.join(map(re.escape, _SYMPTOM_SPECIALTY)) + r')\b')
+_KNOWN_AREA_NAMES = sorted({a for k, v in _NEARBY_AREAS.items() for a in [k] + v})
+_AREA_RE = re.compile(r'\b(' + '|'.join(map(re.escape, _KNOWN_AREA_NAMES)) + r')\b')
+# 这些信号说明查询含姓名/诊所/语言要求，规则覆盖不了，交还给 LLM
+_DEFER_RE = re.compile(r'\b(dr|doctor|find|clinic|chinese|mandarin|english|malay|tamil)\b')
+
+
+def fast_intent(query):
+    """本地规则短路：单一症状词(可带区域)的查询直接生成计划，跳过 LLM 往返。
+    含姓名/诊所/语言等复杂信号时返回 None，照常走 think()。"""
+    q = query.lower()
+    if _DEFER_RE.search(q):
+        return None
+    specialties = {_SYMPTOM_SPECIALTY[m] for m in _SYMPTOM_RE.findall(q)}
+    if len(specialties) != 1:
+        return None
+    areas = _AREA_RE.findall(q)
+    if len(areas) > 1:
+        return None
+    return {
+        "intent": "find_doctor",
+        "keywords": "",
+        "filters": {
+            "Specialty": specialties.pop(),
+            "Languages": "",
+            "Area": areas[0].title() if areas else ""
+        },
+        "reasoning": "本地症状关键词规则直接命中，未调用 LLM"
+    }
+
+
+# 严格输出 schema：数据库里实际存在的专科名 (空串 = 不按专科过滤)
+_ALLOWED_SPECIALTIES = [
+    '', 'General Medicine', 'Family & Community Medicine', 'Emergency Medicine',
+    'Cardiology', 'Gastroenterology', 'Orthopaedic Surgery', 'Ophthalmology',
+    'Otolaryngology', 'Psychiatry', 'Dental', 'Endocrinology', 'Renal Medicine',
+    'Urology', 'Respiratory Medicine'
+]
+
+# strict json_schema 保证响应一定可解析、专科名一定在枚举里，
+# 省掉用散文描述 JSON 结构的提示词 token 和解析失败的重试
+_INTENT_SCHEMA = {
+    "name": "intent",
+    "strict": True,
+    # strict 模式要求每个 object 都声明 additionalProperties: false
+    # 且 required 列出全部属性，否则后端直接拒绝请求
+    "schema": {
+        "type": "object",
+        "required": ["intent", "keywords", "filters", "reasoning"],
+        "additionalProperties": False,
+        "properties": {
+            "intent": {"type": "string", "enum": ["find_doctor", "find_clinic"]},
+            "keywords": {"type": "string"},
+            "filters": {
+                "type": "object",
+                "required": ["Specialty", "Languages", "Area"],
+                "additionalProperties": False,
+                "properties": {
+                    "Specialty": {"type": "string", "enum": _ALLOWED_SPECIALTIES},
+                    "Languages": {"type": "string"},
+                    "Area": {"type": "string"}
+                }
+            },
+            "reasoning": {"type": "string"}
+        }
+    }
+}
+
+# 后端拒绝过一次严格 schema 后就不再重试（避免每次调用都白走一趟失败请求）
+_SCHEMA_UNSUPPORTED = [False]
+
+# 批量模式附加说明：一次请求解析多条查询，系统提示词的 token 只花一次
+_BATCH_PROMPT_SUFFIX = """
+        Batch mode: the user message is a JSON array of queries.
+        Return a JSON object {"plans": [...]} containing one plan object per query, in the same order.
+        """
+
+
+@st.cache_resource(show_spinner=False)
+def get_embedding_model():
+    """语义召回用的小型句向量模型，进程内只加载一次"""
+    return SentenceTransformer('sentence-transformers/all-MiniLM-L6-v2')
+
+
+@st.cache_resource(show_spinner=False)
+def get_client(api_key, base_url):
+    """OpenAI 客户端单例：跨 rerun 复用同一底层 TCP/TLS 连接"""
+    client = OpenAI(api_key=api_key, base_url=base_url)
+    # 测试连接
+    client.models.list()
+    return client
+
+
+@st.cache_data(ttl=3600, show_spinner=False)
+def think_cached(query, model, api_key_hash, _client):
+    """意图解析结果按 (query, model, key) 缓存一小时，重复查询零网络开销。
+    _client 带下划线前缀，Streamlit 不对其做参数哈希。"""
+    messages = [
+        {"role": "system", "content": _INTENT_SYSTEM_PROMPT},
+        {"role": "user", "content": query}
+    ]
+    response = None
+    if not _SCHEMA_UNSUPPORTED[0]:
+        try:
+            response = _client.chat.completions.create(
+                model=model,
+                messages=messages,
+                response_format={"type": "json_schema", "json_schema": _INTENT_SCHEMA},
+                temperature=0.1
+            )
+        except BadRequestError:
+            # 后端以 400 拒绝严格 schema：记住这一点，后续调用直接走 json_object
+            _SCHEMA_UNSUPPORTED[0] = True
+        except Exception:
+            # 瞬时错误 (超时/限流/网络)：本次退回 json_object，但不关掉严格模式
+            pass
+    if response is None:
+        response = _client.chat.completions.create(
+            model=model,
+            messages=messages,
+            response_format={"type": "json_object"},
+            temperature=0.1 # 降低随机性，保证 JSON 格式稳定
+        )
+    return json.loads(response.choices[0].message.content)
+
+
+@st.cache_data(ttl=3600, persist='disk', show_spinner=False,
+               hash_funcs={'streamlit.runtime.uploaded_file_manager.UploadedFile':
+                           lambda f: hashlib.sha256(f.getvalue()).hexdigest()})
+def _parse_data_files(file_c, file_d):
+    """纯解析层：读文件 + Arrow 字符串化 + 列名标准化。
+    persist='disk' 让应用重启后同一份文件也不必重新解析 (xlsx 解析最贵)；
+    上传文件按内容哈希作缓存键：同一份文件重新上传（file_id 会变）或
+    换会话再传，都直接命中磁盘缓存。
+    派生索引 (attrs 上的名单缓存/位图/语义索引) 留在 load_data 的
+    cache_resource 层，因其不可/不值得 pickle 落盘。"""
+    # 读取文件辅助函数 (PyArrow 后端: 字符串列原生存储, 无逐格 PyObject)
+    def read_file(f):
+        fname = f if isinstance(f, str) else f.name
+        if fname.endswith('.csv'):
+            return pd.read_csv(f, engine='pyarrow', dtype_backend='pyarrow')
+        return pd.read_excel(f, engine='openpyxl', dtype_backend='pyarrow')
+
+    # 整表转 Arrow 字符串 + 填空，替代原来的 fillna + 逐列 astype(str) 循环。
+    # 用 32 位偏移的 string (而非 large_string)：这类表远小于 2GB，偏移数组省一半内存
+    df_c = read_file(file_c).astype('string[pyarrow]').fillna('')
+    df_d = read_file(file_d).astype('string[pyarrow]').fillna('')
+
+    # === 核心优化：建立列名映射字典 ===
+    # 目的是让代码里的 'Name', 'Area' 能对应上 Excel 里千奇百怪的表头
+
+    # 医生表映射 - 基于实际文件结构
+    d_map = {}
+    for col in df_d.columns:
+        cl = col.lower()
+        if 'doctor name' in cl or 'name' in cl: d_map[col] = 'Name'
+        elif 'specialty' in cl: d_map[col] = 'Specialty'
+        elif 'languages spoken' in cl or 'language' in cl: d_map[col] = 'Languages'
+        elif 'services' in cl: d_map[col] = 'Services'
+        elif 'qualifications' in cl: d_map[col] = 'Qualifications'
+        elif 'designation' in cl: d_map[col] = 'Designation'
+
+    # 诊所表映射 - 基于实际文件结构
+    c_map = {}
+    for col in df_c.columns:
+        cl = col.lower()
+        if 'gp clinic name' in cl or 'clinic name' in cl: c_map[col] = 'Name'
+        elif 'clinic address' in cl or 'address' in cl: c_map[col] = 'Address'
+        elif 'area' in cl: c_map[col] = 'Area'
+        elif 'contact' in cl: c_map[col] = 'Contact'  # 'Clinic Contact' 等统一归一，下游不再做双重 get 回退
+
+    if d_map: df_d.rename(columns=d_map, inplace=True)
+    if c_map: df_c.rename(columns=c_map, inplace=True)
+
+    return df_c, df_d
+
 
 class MedicalAgent:
     def __init__(self):
         self.client = None
+        self.aclient = None
+        self.api_key_hash = None
         self.model = "deepseek-ai/DeepSeek-V3" # 默认推荐模型
 
     def connect_api(self, api_key, base_url):
         if not HAS_OPENAI: return False, "未安装 openai 库"
         try:
-            self.client = OpenAI(api_key=api_key, base_url=base_url)
-            # 测试连接
-            self.client.models.list()
+            self.client = get_client(api_key, base_url)
+            self.aclient = AsyncOpenAI(api_key=api_key, base_url=base_url)
+            self.api_key_hash = hashlib.sha256(api_key.encode()).hexdigest()
             return True, "连接成功"
         except Exception as e:
             return False, str(e)
 
-    @st.cache_data(ttl=3600)
+    @st.cache_resource(ttl=3600, show_spinner=False,
+                       hash_funcs={'streamlit.runtime.uploaded_file_manager.UploadedFile':
+                                   lambda f: hashlib.sha256(f.getvalue()).hexdigest()})
     def load_data(_self, file_c, file_d):
-        """智能加载数据，自动标准化列名"""
+        """智能加载数据，自动标准化列名。
+
+        cache_resource 命中时直接返回内存中的同一对象，省掉 cache_data 的
+        pickle 往返；上传文件按内容哈希，重新上传同一份文件也命中。调用方须
+        把返回的两个 DataFrame 当只读用（search 的筛选全走掩码，不会原地修改）。"""
         try:
             # 检查xlsx文件依赖
             if not HAS_OPENPYXL and (file_c.name.endswith('.xlsx') or file_d.name.endswith('.xlsx')):
                 st.error("❌ 需要安装 openpyxl 来读取 .xlsx 文件，请运行: pip install openpyxl")
                 return None, None
                 
-            # 读取文件辅助函数
-            def read_file(f):
-                if isinstance(f, str): return pd.read_csv(f) if f.endswith('.csv') else pd.read_excel(f)
-                return pd.read_csv(f) if f.name.endswith('.csv') else pd.read_excel(f)
+            # 解析层独立缓存并落盘；本层只负责构建内存派生索引
+            df_c, df_d = _parse_data_files(file_c, file_d)
 
-            df_c = read_file(file_c)
-            df_d = read_file(file_d)
-           
-            # 使用object类型来避免dtype兼容性警告
-            df_c = df_c.fillna('')
-            df_d = df_d.fillna('')
+            # === 性能优化：姓名列只做一次小写化和分词 ===
+            # 模糊匹配的三个 scorer 不用每次查询都重新处理字符串
+            if 'Name' in df_d.columns:
+                df_d.attrs['name_list'] = df_d['Name'].str.lower().tolist()
 
-            # === 核心优化：建立列名映射字典 ===
-            # 目的是让代码里的 'Name', 'Area' 能对应上 Excel 里千奇百怪的表头
-           
-            # 医生表映射 - 基于实际文件结构
-            d_map = {}
-            for col in df_d.columns:
-                cl = col.lower()
-                if 'doctor name' in cl or 'name' in cl: d_map[col] = 'Name'
-                elif 'specialty' in cl: d_map[col] = 'Specialty'
-                elif 'languages spoken' in cl or 'language' in cl: d_map[col] = 'Languages'
-                elif 'services' in cl: d_map[col] = 'Services'
-                elif 'qualifications' in cl: d_map[col] = 'Qualifications'
-                elif 'designation' in cl: d_map[col] = 'Designation'
-           
-            # 诊所表映射 - 基于实际文件结构  
-            c_map = {}
-            for col in df_c.columns:
-                cl = col.lower()
-                if 'gp clinic name' in cl or 'clinic name' in cl: c_map[col] = 'Name'
-                elif 'clinic address' in cl or 'address' in cl: c_map[col] = 'Address'
-                elif 'area' in cl: c_map[col] = 'Area'
+            # 预拼接搜索列：多列 str.contains 合并为对单列的一次扫描
+            def join_search_cols(df, cols):
+                s = df[cols[0]]
+                if len(cols) > 1:
+                    s = s.str.cat([df[c] for c in cols[1:]], sep='|', na_rep='')
+                return s.str.lower()
+
+            spec_cols = [c for c in ['Specialty', 'Designation', 'Services'] if c in df_d.columns]
+            if spec_cols:
+                df_d['_search_spec'] = join_search_cols(df_d, spec_cols)
+            loc_cols = [c for c in ['Area', 'Address'] if c in df_c.columns]
+            if loc_cols:
+                df_c['_search_loc'] = join_search_cols(df_c, loc_cols)
+
+            # 常用文本列各留一份小写影子列：查询端改用小写关键字 + regex=False，
+            # 免去 case=False 每次对整列做大小写折叠
+            for df in (df_c, df_d):
+                for col in ['Name', 'Area', 'Address', 'Languages', 'Specialty']:
+                    if col in df.columns:
+                        df[f'_{col.lower()}_lc'] = df[col].str.lower()
+
+            # 语义召回索引 (可选依赖)：子串和编辑距离都覆盖不了
+            # "eye doctor who speaks mandarin" 这类表述；嵌入只算一次并落盘
+            if HAS_SEMANTIC and 'Name' in df_d.columns:
+                try:
+                    texts = (df_d['Name'] + ' ' + df_d.get('Specialty', '') + ' ' + df_d.get('Languages', '')).tolist()
+                    emb_path = f".emb_cache_{hashlib.sha256(chr(10).join(texts).encode()).hexdigest()[:16]}.npy"
+                    if os.path.exists(emb_path):
+                        embs = np.load(emb_path)
+                    else:
+                        embs = get_embedding_model().encode(texts, normalize_embeddings=True, batch_size=64)
+                        # FP16 落盘：体积减半，召回损失可忽略 (入索引前仍转回 float32)
+                        np.save(emb_path, embs.astype(np.float16))
+                    sem_index = faiss.IndexHNSWFlat(embs.shape[1], 32)
+                    sem_index.add(np.ascontiguousarray(embs, dtype=np.float32))
+                    df_d.attrs['semantic_index'] = sem_index
+                except Exception as e:
+                    print(f"Semantic index build failed: {e}")
+
+            # 已知区域的匹配位图：每个区域一列 uint8，区域查询退化为一次列索引
+            # + O(n_clinics) 字节扫描，不再做任何字符串匹配
+            if '_search_loc' in df_c.columns:
+                area_mat = np.zeros((len(df_c), len(_KNOWN_AREA_NAMES)), dtype=np.uint8)
+                for j, area_name in enumerate(_KNOWN_AREA_NAMES):
+                    area_mat[:, j] = df_c['_search_loc'].str.contains(area_name, regex=False, na=False).to_numpy(dtype=bool, na_value=False)
+                df_c.attrs['area_mat'] = area_mat
+
+            # 仅按 Area 列的位图：邻近区域推荐只看诊所所在区域，
+            # 不能把地址里碰巧出现的路名 (如 "5 Tampines Road") 当作邻近命中
+            if '_area_lc' in df_c.columns:
+                area_only_mat = np.zeros((len(df_c), len(_KNOWN_AREA_NAMES)), dtype=np.uint8)
+                for j, area_name in enumerate(_KNOWN_AREA_NAMES):
+                    area_only_mat[:, j] = df_c['_area_lc'].str.contains(area_name, regex=False, na=False).to_numpy(dtype=bool, na_value=False)
+                df_c.attrs['area_only_mat'] = area_only_mat
 
-            if d_map: df_d.rename(columns=d_map, inplace=True)
-            if c_map: df_c.rename(columns=c_map, inplace=True)
+            # 邮编预提取为数值列，邮编距离检索全程走 NumPy，查询时不再逐行 regex
+            if 'Address' in df_c.columns:
+                # Arrow 后端的 str.extract 要求具名分组
+                postal = df_c['Address'].str.extract(r'Singapore\s+(?P<postal>\d{6})', expand=False)
+                df_c['_postal'] = pd.to_numeric(postal, errors='coerce').astype('Int32')
 
-            # 统一转字符串
-            for df in [df_c, df_d]:
-                for col in df.columns: df[col] = df[col].astype(str)
+                # 邮编分桶空间索引：前两位是邮政分区，分区差在距离度量里以 10000 为步长
+                # 绝对主导（区内分量 < 100），因此查询时按分区距离由近及远展开分桶，
+                # 凑够候选即可停，结果与全表扫描一致
+                p_all = df_c['_postal'].to_numpy(dtype=np.float64, na_value=np.nan)
+                sectors = {}
+                for pos in np.flatnonzero(~np.isnan(p_all)):
+                    sectors.setdefault(int(p_all[pos]) // 10000, []).append(int(pos))
+                df_c.attrs['postal_sectors'] = {s: np.array(v) for s, v in sectors.items()}
+
+            # 弹窗 HTML 的静态部分在载入时一次性预渲染（保留 $distance_row 占位），
+            # 建图时只需填距离行；同一诊所出现在多轮查询里不再重复做模板替换
+            if 'Name' in df_c.columns:
+                n_rows = len(df_c)
+                areas = df_c['Area'] if 'Area' in df_c.columns else [''] * n_rows
+                addrs = df_c['Address'] if 'Address' in df_c.columns else [''] * n_rows
+                contacts = df_c['Contact'] if 'Contact' in df_c.columns else [''] * n_rows
+                df_c['_popup_html'] = [
+                    _POPUP_TMPL.safe_substitute(
+                        name=html.escape(str(n)), area=html.escape(str(a)),
+                        address=html.escape(str(ad)), contact=html.escape(str(ct)))
+                    for n, a, ad, ct in zip(df_c['Name'], areas, addrs, contacts)
+                ]
 
             return df_c, df_d
         except Exception as e:
@@ -124,82 +613,72 @@ class MedicalAgent:
         """
         if not self.client: return None
 
-        system_prompt = """
-        You are a medical search intent analyzer.
-        Target Data:
-        1. Doctors (Fields: Name, Specialty, Languages, Services)
-        2. Clinics (Fields: Name, Address, Area)
+        try:
+            return think_cached(query, self.model, self.api_key_hash, self.client)
+        except Exception as e:
+            st.error(f"Agent 思考失败: {e}")
+            return None
 
-        Task: Parse user query into a JSON object.
-       
-        Logic for parsing:
-        1. ***LOCATION SEARCH PRIORITY***: If query contains "nearest", "closest", "near", "around", "离...最近" patterns, set intent="find_clinic" and extract location to "Area" field.
-        2. ***NAME DETECTION***: If query contains patterns like "find dr. [name]", "doctor [name]", or specific names, extract to "keywords" field and leave "Specialty" EMPTY.
-        3. Location extraction: Singapore areas like "Bedok", "Tampines", "Yishun", "Ang Mo Kio", "Woodlands", etc. -> "Area" field
-        4. Language extraction: "Chinese", "Mandarin", "English" etc. -> "Languages" field  
-        5. ***SPECIALTY FROM SYMPTOMS*** (only if NO specific name mentioned): ONLY use these EXACT names that exist in database:
-          - "fever/cold/flu/general illness/sick" -> "General Medicine" (NOT "General Practitioner")
-          - "baby/kid/child/infant" -> "Family & Community Medicine"
-          - "emergency/urgent/serious" -> "Emergency Medicine"
-          - "heart/chest pain/cardiac" -> "Cardiology"
-          - "stomach/gut/digestive" -> "Gastroenterology"
-          - "bone/fracture/injury" -> "Orthopaedic Surgery"
-          - "eye/vision" -> "Ophthalmology"
-          - "throat/ear/nose" -> "Otolaryngology"
-          - "mental/depression/anxiety" -> "Psychiatry"
-          - "tooth/teeth/dentist" -> "Dental"
-          - "diabetes/sugar" -> "Endocrinology"
-          - "kidney/renal" -> "Renal Medicine"
-          - "urine/bladder" -> "Urology"
-          - "breathing/lung" -> "Respiratory Medicine"
-          - Default: "General Medicine" for common symptoms
-       
-        Output JSON Format:
-        {
-            "intent": "find_doctor" or "find_clinic",
-            "keywords": "Specific name of person or clinic (leave empty if general search)",
-            "filters": {
-                "Specialty": "...",
-                "Languages": "...",
-                "Area": "..."
-            },
-            "reasoning": "Brief explanation of inference"
-        }
-        
-        Examples:
-        - "nearest clinic to Bedok" -> intent: "find_clinic", keywords: "", Area: "Bedok" (location-based clinic search)
-        - "clinics near Tampines" -> intent: "find_clinic", keywords: "", Area: "Tampines" (location-based clinic search)
-        - "clinic nearest 641652" -> intent: "find_clinic", keywords: "", Area: "641652" (postal code-based search)
-        - "i want clinic nearest 560123" -> intent: "find_clinic", keywords: "", Area: "560123" (postal code search)
-        - "find dr. low" -> intent: "find_doctor", keywords: "low", Specialty: "" (doctor name search)
-        - "find doctor smith" -> intent: "find_doctor", keywords: "smith", Specialty: "" (doctor name search)
-        - "i want jam avin" -> intent: "find_doctor", keywords: "jam avin", Specialty: "" (doctor name search)
-        - "i have fever" -> intent: "find_doctor", keywords: "", Specialty: "General Medicine" (symptom-based search)
-        - "baby sick" -> intent: "find_doctor", keywords: "", Specialty: "Family & Community Medicine" (symptom-based search)
-        """
+    async def think_many(self, queries):
+        """并发解析一批查询意图 (如自动补全/推荐问法)。
+        LLM 接口逐个请求吃不满 RPM，asyncio.gather 并发后整批耗时约等于最慢的一次调用。
+        调用方用 asyncio.run(agent.think_many(queries))。"""
+        if not self.aclient:
+            return [None] * len(queries)
+        sem = asyncio.Semaphore(8)
 
+        async def one(q):
+            async with sem:
+                try:
+                    response = await self.aclient.chat.completions.create(
+                        model=self.model,
+                        messages=[
+                            {"role": "system", "content": _INTENT_SYSTEM_PROMPT},
+                            {"role": "user", "content": q}
+                        ],
+                        response_format={"type": "json_object"},
+                        temperature=0.1
+                    )
+                    return json.loads(response.choices[0].message.content)
+                except Exception:
+                    return None
+
+        return await asyncio.gather(*map(one, queries))
+
+    def think_batch(self, queries):
+        """把 K 条查询拼进同一次 LLM 调用 (受 RPM 限制时用)。
+        单次延迟略升，但有效吞吐约 K 倍，且 ~800 token 的系统提示词不再按条重复计费。"""
+        if not queries:
+            return []
+        if not self.client:
+            return [None] * len(queries)
         try:
             response = self.client.chat.completions.create(
                 model=self.model,
                 messages=[
-                    {"role": "system", "content": system_prompt},
-                    {"role": "user", "content": query}
+                    {"role": "system", "content": _INTENT_SYSTEM_PROMPT + _BATCH_PROMPT_SUFFIX},
+                    {"role": "user", "content": json.dumps(queries, ensure_ascii=False)}
                 ],
                 response_format={"type": "json_object"},
-                temperature=0.1 # 降低随机性，保证 JSON 格式稳定
+                temperature=0.1
             )
-            return json.loads(response.choices[0].message.content)
+            plans = json.loads(response.choices[0].message.content).get('plans', [])
+            # 数量对不上时补 None，保证与输入一一对应
+            plans = plans[:len(queries)] + [None] * (len(queries) - len(plans))
+            return plans
         except Exception as e:
-            st.error(f"Agent 思考失败: {e}")
-            return None
+            st.error(f"Agent 批量思考失败: {e}")
+            return [None] * len(queries)
 
     def search(self, df_c, df_d, query):
         # 检查数据是否加载成功
         if df_c is None or df_d is None:
             return [], {"error": "数据文件未正确加载，请检查上传的文件格式"}
             
-        # 1. 思考 (Think)
-        plan = self.think(query)
+        # 1. 思考 (Think) - 简单症状查询先走本地规则，命中则省掉 LLM 往返
+        plan = fast_intent(query)
+        if plan is None:
+            plan = self.think(query)
         if not plan:
             return [], "API 未连接或思考失败，无法执行智能搜索。"
 
@@ -208,26 +687,27 @@ class MedicalAgent:
         keywords = plan.get('keywords', '')
         reasoning = plan.get('reasoning', '')
 
-        # 准备数据源
+        # 准备数据源 (不复制整表：所有筛选先走布尔掩码，最后才物化)
         if intent == 'find_clinic':
-            target_df = df_c.copy()
+            target_df = df_c
             rtype = 'Clinic'
         else:
-            target_df = df_d.copy()
+            target_df = df_d
             rtype = 'Doctor'
 
         # 2. 结构化过滤 (Filter) - Pandas 硬筛选
         # 这一步保证了准确性 (Precision)
-        filtered_df = target_df
-       
+        mask = np.ones(len(target_df), dtype=bool)
+        filtered_df = None  # 仅邮编分支需要按距离排序，会提前物化
+
         # 专科筛选 - 修正AI可能输出的错误专科名称
         if filters.get('Specialty'):
             specialty_filter = filters['Specialty']
-            
+
             # AI专科名称修正映射
             specialty_corrections = {
                 'General Practitioner': 'General Medicine',
-                'GP': 'General Medicine', 
+                'GP': 'General Medicine',
                 'Family Medicine': 'Family & Community Medicine',
                 'Paediatric': 'Family & Community Medicine',  # 儿科查询修正
                 'Pediatric': 'Family & Community Medicine',
@@ -235,123 +715,126 @@ class MedicalAgent:
                 'Orthopaedic': 'Orthopaedic Surgery',
                 'Orthopedic': 'Orthopaedic Surgery'
             }
-            
+
             # 应用修正
             if specialty_filter in specialty_corrections:
                 specialty_filter = specialty_corrections[specialty_filter]
-            
+
             # 对于儿科查询，直接推荐全科医生等更适合的专科
             if specialty_filter.lower() in ['paediatric', 'pediatric']:
                 # 儿科查询优先推荐全科、急诊、内科医生
                 fallback_specialties = ['Family & Community Medicine', 'General Medicine', 'Emergency Medicine', 'Internal Medicine']
-                fallback_matches = pd.Series([False] * len(filtered_df))
-                for fallback in fallback_specialties:
-                    if 'Specialty' in filtered_df.columns:
-                        matches = filtered_df['Specialty'].str.contains(fallback, case=False, na=False)
-                        fallback_matches = fallback_matches | matches
-                filtered_df = filtered_df[fallback_matches]
-                
+                fallback_mask = np.zeros(len(target_df), dtype=bool)
+                if '_specialty_lc' in target_df.columns:
+                    for fallback in fallback_specialties:
+                        fallback_mask |= target_df['_specialty_lc'].str.contains(fallback.lower(), regex=False, na=False).to_numpy(dtype=bool, na_value=False)
+                if (mask & fallback_mask).any():
+                    mask &= fallback_mask
                 # 如果还是没找到，再搜索儿科专门服务
-                if filtered_df.empty:
-                    specialty_matches = pd.Series([False] * len(target_df))
-                    search_columns = ['Specialty', 'Designation', 'Services']
-                    for col in search_columns:
-                        if col in target_df.columns:
-                            matches = target_df[col].str.contains(specialty_filter, case=False, na=False)
-                            specialty_matches = specialty_matches | matches
-                    filtered_df = target_df[specialty_matches]
+                elif '_search_spec' in target_df.columns:
+                    mask = target_df['_search_spec'].str.contains(specialty_filter.lower(), regex=False, na=False).to_numpy(dtype=bool, na_value=False)
+                else:
+                    mask = np.zeros(len(target_df), dtype=bool)
             else:
-                # 非儿科查询，正常搜索
-                specialty_matches = pd.Series([False] * len(filtered_df))
-                search_columns = ['Specialty', 'Designation', 'Services']
-                for col in search_columns:
-                    if col in filtered_df.columns:
-                        matches = filtered_df[col].str.contains(specialty_filter, case=False, na=False)
-                        specialty_matches = specialty_matches | matches
-                filtered_df = filtered_df[specialty_matches]
-       
+                # 非儿科查询，正常搜索 (单列扫描代替逐列 str.contains)
+                if '_search_spec' in target_df.columns:
+                    mask &= target_df['_search_spec'].str.contains(specialty_filter.lower(), regex=False, na=False).to_numpy(dtype=bool, na_value=False)
+                else:
+                    mask &= False
+
         # 语言筛选
-        if filters.get('Languages') and 'Languages' in filtered_df.columns:
+        if filters.get('Languages') and '_languages_lc' in target_df.columns:
             # 处理 "Chinese" 这种统称
-            lang = filters['Languages']
-            if lang.lower() in ['chinese', 'mandarin']: lang = 'Mandarin' # 假设表里是 Mandarin
-            filtered_df = filtered_df[filtered_df['Languages'].str.contains(lang, case=False, na=False)]
+            lang = filters['Languages'].lower()
+            if lang in ['chinese', 'mandarin']: lang = 'mandarin' # 假设表里是 Mandarin
+            mask &= target_df['_languages_lc'].str.contains(lang, regex=False, na=False).to_numpy(dtype=bool, na_value=False)
 
         # 智能地理位置筛选 - 针对诊所搜索优化，支持邮政编码
         loc_key = filters.get('Area')
         if loc_key and intent == 'find_clinic':
             # 检查是否为邮政编码（6位数字）
             if loc_key.isdigit() and len(loc_key) == 6:
-                # 邮政编码搜索逻辑
-                import re
+                # 邮政编码搜索逻辑：对预提取的 _postal 列做向量化距离计算
+                # 前2位是区域代码，后4位是区域内位置 (与原 calculate_postal_distance 同构)
                 query_postal = int(loc_key)
-                clinic_distances = []
-                
-                # 从地址中提取所有邮政编码并计算距离
-                for idx, row in filtered_df.iterrows():
-                    address = str(row.get('Address', ''))
-                    postal_match = re.search(r'Singapore\s+(\d{6})', address)
-                    if postal_match:
-                        clinic_postal = int(postal_match.group(1))
-                        # 使用更准确的距离计算
-                        distance = self.calculate_postal_distance(query_postal, clinic_postal)
-                        # 将row转换为字典并添加距离信息
-                        clinic_data = dict(row)
-                        clinic_data['_distance'] = distance
-                        clinic_distances.append(clinic_data)
-                
-                # 按距离排序并取前20个
-                if clinic_distances:
-                    clinic_distances.sort(key=lambda x: x['_distance'])
-                    closest_clinics = clinic_distances[:20]
-                    filtered_df = pd.DataFrame(closest_clinics)
+                if '_postal' in target_df.columns:
+                    p = target_df['_postal'].to_numpy(dtype=np.float64, na_value=np.nan)
+                else:
+                    p = np.full(len(target_df), np.nan)
+
+                # 先走分桶索引：按分区距离从近到远展开，凑够 20 个候选即停；
+                # 同一环距的分桶必须整环纳入，保证与全表扫描结果一致
+                sectors = target_df.attrs.get('postal_sectors')
+                if sectors:
+                    q_sector = query_postal // 10000
+                    rings = {}
+                    for s, pos in sectors.items():
+                        rings.setdefault(abs(s - q_sector), []).append(pos)
+                    cand_pos, total = [], 0
+                    for ring_d in sorted(rings):
+                        for pos in rings[ring_d]:
+                            cand_pos.append(pos)
+                            total += int(mask[pos].sum())
+                        if total >= 20:
+                            break
+                    cand = np.concatenate(cand_pos) if cand_pos else np.array([], dtype=np.int64)
+                else:
+                    cand = np.arange(len(target_df))
+
+                p_c = p[cand]
+                valid = ~np.isnan(p_c) & mask[cand]
+                distances = np.abs(p_c // 10000 - query_postal // 10000) * 10000 \
+                    + np.abs(p_c % 10000 - query_postal % 10000) / 100
+                distances = np.where(valid, distances, np.inf)
+
+                if valid.any():
+                    # argpartition 取最近的20家再排序
+                    k = min(20, len(distances))
+                    nearest = np.argpartition(distances, k - 1)[:k]
+                    nearest = nearest[np.argsort(distances[nearest])]
+                    nearest = nearest[np.isfinite(distances[nearest])]
+                    filtered_df = target_df.iloc[cand[nearest]].copy()
+                    filtered_df['_distance'] = distances[nearest]
                 else:
                     # 如果没有找到邮政编码，返回空结果
                     filtered_df = pd.DataFrame()
             else:
                 # 常规区域名称搜索
                 # 多层次地理匹配策略
-                location_matches = pd.Series([False] * len(filtered_df))
-                
-                # 1. 精确区域匹配 (最高优先级)
-                if 'Area' in filtered_df.columns:
-                    exact_area_matches = filtered_df['Area'].str.contains(loc_key, case=False, na=False)
-                    location_matches = location_matches | exact_area_matches
-                
-                # 2. 地址部分匹配 (用于更精确的位置搜索)
-                if 'Address' in filtered_df.columns:
-                    address_matches = filtered_df['Address'].str.contains(loc_key, case=False, na=False) 
-                    location_matches = location_matches | address_matches
-                
-                # 3. 如果没有直接匹配，尝试邻近区域推荐
-                if not location_matches.any():
-                    # 新加坡邻近区域映射 (基于实际地理位置)
-                    nearby_areas = {
-                        'bedok': ['tampines', 'pasir ris', 'changi'],
-                        'tampines': ['bedok', 'pasir ris', 'sengkang'],
-                        'yishun': ['woodlands', 'sembawang', 'ang mo kio'],
-                        'woodlands': ['yishun', 'sembawang', 'choa chu kang'],
-                        'jurong west': ['jurong east', 'choa chu kang', 'bukit batok'],
-                        'sengkang': ['punggol', 'tampines', 'serangoon'],
-                        'punggol': ['sengkang', 'tampines', 'serangoon'],
-                        'ang mo kio': ['yishun', 'serangoon', 'bishan'],
-                        'serangoon': ['ang mo kio', 'sengkang', 'bishan']
-                    }
-                    
-                    loc_key_lower = loc_key.lower()
-                    if loc_key_lower in nearby_areas:
-                        nearby_list = nearby_areas[loc_key_lower]
-                        for nearby in nearby_list:
-                            if 'Area' in filtered_df.columns:
-                                nearby_matches = filtered_df['Area'].str.contains(nearby, case=False, na=False)
-                                location_matches = location_matches | nearby_matches
-                
-                filtered_df = filtered_df[location_matches]
+                loc_lower = loc_key.lower()
+                area_mat = target_df.attrs.get('area_mat')
+
+                # 1+2. 区域/地址匹配：已知区域直接取预计算位图列，否则对 _search_loc 做一次扫描
+                if area_mat is not None and loc_lower in _KNOWN_AREA_NAMES:
+                    location_matches = area_mat[:, _KNOWN_AREA_NAMES.index(loc_lower)].astype(bool)
+                elif '_search_loc' in target_df.columns:
+                    location_matches = target_df['_search_loc'].str.contains(loc_lower, regex=False, na=False).to_numpy(dtype=bool, na_value=False)
+                else:
+                    location_matches = np.zeros(len(target_df), dtype=bool)
+
+                # 3. 如果没有直接匹配，尝试邻近区域推荐 (仅按 Area 位图按列取或，
+                # 退化时用交替式扫描)——两条路径都只看区域列，与原始语义一致
+                if not (mask & location_matches).any():
+                    siblings = _NEARBY_AREAS.get(loc_lower)
+                    area_only_mat = target_df.attrs.get('area_only_mat')
+                    if siblings and area_only_mat is not None:
+                        cols = [_KNOWN_AREA_NAMES.index(s) for s in siblings]
+                        location_matches = location_matches | area_only_mat[:, cols].any(axis=1)
+                    else:
+                        nearby_pattern = _NEARBY_PATTERNS.get(loc_lower)
+                        if nearby_pattern and '_area_lc' in target_df.columns:
+                            location_matches = location_matches | target_df['_area_lc'].str.contains(nearby_pattern, regex=True, na=False).to_numpy(dtype=bool, na_value=False)
+
+                mask &= location_matches
         elif loc_key and intent == 'find_doctor':
-            # 医生搜索的地址筛选 (保持原逻辑)
-            col_to_search = 'Area' if 'Area' in filtered_df.columns else 'Address'  
-            if col_to_search in filtered_df.columns:
-                filtered_df = filtered_df[filtered_df[col_to_search].str.contains(loc_key, case=False, na=False)]
+            # 医生搜索的地址筛选 (保持原逻辑，换用小写影子列)
+            col_to_search = '_area_lc' if '_area_lc' in target_df.columns else '_address_lc'
+            if col_to_search in target_df.columns:
+                mask &= target_df[col_to_search].str.contains(loc_key.lower(), regex=False, na=False).to_numpy(dtype=bool, na_value=False)
+
+        # 掩码只在结果构建前物化一次
+        if filtered_df is None:
+            filtered_df = target_df.iloc[np.flatnonzero(mask)]
 
         # 3. 模糊匹配 (Fuzzy Match) - RapidFuzz
         # 这一步保证了容错性 (Recall)
@@ -362,88 +845,60 @@ class MedicalAgent:
             # 诊所搜索：按地理位置优先级排序
             if intent == 'find_clinic':
                 if loc_key:
-                    # 按地理相关性排序
-                    exact_area = []
-                    exact_address = []
-                    nearby_area = []
-                    
-                    for _, row in filtered_df.iterrows():
-                        area = str(row.get('Area', '')).lower()
-                        address = str(row.get('Address', '')).lower()
-                        loc_lower = loc_key.lower()
-                        
-                        # 精确区域匹配最优先
-                        if loc_lower in area:
-                            exact_area.append(row)
-                        # 地址匹配次优先  
-                        elif loc_lower in address:
-                            exact_address.append(row)
-                        # 邻近区域最后
-                        else:
-                            nearby_area.append(row)
-                    
-                    # 按优先级合并结果，每类最多10个
-                    results = exact_area[:10] + exact_address[:5] + nearby_area[:5]
+                    # 按地理相关性排序：向量化优先级代替 iterrows 逐行分桶
+                    loc_lower = loc_key.lower()
+                    if '_area_lc' in filtered_df.columns:
+                        area_match = filtered_df['_area_lc'].str.contains(loc_lower, regex=False, na=False).to_numpy(dtype=bool, na_value=False)
+                    else:
+                        area_match = np.zeros(len(filtered_df), dtype=bool)
+                    if '_address_lc' in filtered_df.columns:
+                        addr_match = filtered_df['_address_lc'].str.contains(loc_lower, regex=False, na=False).to_numpy(dtype=bool, na_value=False)
+                    else:
+                        addr_match = np.zeros(len(filtered_df), dtype=bool)
+
+                    # 优先级: 0=精确区域, 1=地址命中, 2=邻近区域; stable 排序保持原行序
+                    pri = np.select([area_match, addr_match & ~area_match], [0, 1], default=2)
+                    order = np.argsort(pri, kind='stable')
+                    pri_sorted = pri[order]
+                    # 每类配额与原分桶逻辑一致: 区域10 / 地址5 / 邻近5
+                    keep = np.concatenate([
+                        np.flatnonzero(pri_sorted == 0)[:10],
+                        np.flatnonzero(pri_sorted == 1)[:5],
+                        np.flatnonzero(pri_sorted == 2)[:5],
+                    ])
+                    results = filtered_df.iloc[order[keep]].to_dict('records')
                 else:
                     # 没有指定位置，返回前15个诊所
-                    results = [row for _, row in filtered_df.head(15).iterrows()]
+                    results = filtered_df.head(15).to_dict('records')
                     
             # 医生搜索：按姓名模糊匹配  
             elif keywords and len(keywords) > 1:
                 # 多种模糊匹配策略，扩大搜索范围
-                names = filtered_df['Name'].tolist()
-                
-                # 策略1: token_set_ratio (对单词顺序不敏感)
-                matches1 = process.extract(keywords, names, limit=20, scorer=fuzz.token_set_ratio)
-                
-                # 策略2: partial_ratio (部分匹配) - 提高limit以捕获更多候选
-                matches2 = process.extract(keywords, names, limit=20, scorer=fuzz.partial_ratio)
-                
-                # 策略3: token_sort_ratio (排序后匹配)
-                matches3 = process.extract(keywords, names, limit=20, scorer=fuzz.token_sort_ratio)
-                
-                # 策略4: 专门处理多词姓名的部分匹配
-                multi_word_matches = []
-                keywords_words = keywords.lower().split()
-                for i, name in enumerate(names):
-                    name_words = name.lower().split()
-                    # 检查keywords中的每个词是否在姓名中有部分匹配
-                    word_match_scores = []
-                    for kw in keywords_words:
-                        best_word_score = 0
-                        for nw in name_words:
-                            if len(kw) >= 3:  # 只对长度>=3的词进行部分匹配
-                                if kw in nw or nw in kw:
-                                    best_word_score = max(best_word_score, 80)
-                                else:
-                                    score = fuzz.ratio(kw, nw)
-                                    best_word_score = max(best_word_score, score)
-                        word_match_scores.append(best_word_score)
-                    
-                    # 如果所有关键词都有合理匹配，计算总分
-                    if len(word_match_scores) > 0 and min(word_match_scores) > 35:
-                        avg_score = sum(word_match_scores) / len(word_match_scores)
-                        multi_word_matches.append((name, avg_score, i))
-                
-                # 合并所有匹配结果，提高分数权重
-                all_matches = {}
-                for strategy_name, matches in [("token_set", matches1), ("partial", matches2), ("token_sort", matches3), ("multi_word", multi_word_matches)]:
-                    for name, score, idx in matches:
-                        if score > 25:
-                            # 对不同策略给予不同权重，partial_ratio对精确匹配更敏感
-                            weighted_score = score
-                            if strategy_name == "multi_word" and score > 50:
-                                weighted_score = score * 1.3  # 多词匹配策略权重最高
-                            elif strategy_name == "partial" and score > 80:
-                                weighted_score = score * 1.2  # 提升精确匹配的权重
-                            elif strategy_name == "token_set" and score > 90:
-                                weighted_score = score * 1.1  # 提升高质量token匹配
-                                
-                            if name not in all_matches or weighted_score > all_matches[name][0]:
-                                all_matches[name] = (weighted_score, idx, score)  # 保存原始分数用于调试
-                
-                # 按加权分数排序，确保最匹配的在前面
-                sorted_matches = sorted(all_matches.items(), key=lambda x: x[1][0], reverse=True)
+                # 复用 load_data 里预先小写化/分词好的姓名缓存，避免每次查询重复处理
+                cached_names = filtered_df.attrs.get('name_list')
+                if cached_names is not None:
+                    positions = target_df.index.get_indexer(filtered_df.index)
+                    names = [cached_names[p] for p in positions]
+                else:
+                    names = filtered_df['Name'].str.lower().tolist()
+                keywords_lc = keywords.lower()
+
+                # 单次 WRatio cdist 批量打分 (C++ 层一次算完, workers=-1 多线程)。
+                # WRatio 内部已组合 token_set/partial/token_sort 三种策略，
+                # 不必再各跑一遍后手工加权；精确前缀匹配的加成在下方单独处理
+                original_scores = process.cdist(
+                    [keywords_lc], names, scorer=fuzz.WRatio, processor=None, workers=-1
+                )[0].astype(np.float64)
+                weighted_scores = np.where(original_scores > 25, original_scores, 0.0)
+
+                # argpartition 取 top-K 候选，再按加权分数排序，确保最匹配的在前面
+                k = min(20, len(names))
+                top_idx = np.argpartition(-weighted_scores, k - 1)[:k]
+                top_idx = top_idx[np.argsort(-weighted_scores[top_idx])]
+                sorted_matches = [
+                    (names[i], (float(weighted_scores[i]), int(i), float(original_scores[i])))
+                    for i in top_idx if weighted_scores[i] > 0
+                ]
                 
                 # 进一步优化：精确匹配优先
                 exact_matches = []
@@ -486,108 +941,71 @@ class MedicalAgent:
                 limit = 10 if intent == 'find_doctor' else 15
                 results = [row for _, row in filtered_df.head(limit).iterrows()]
 
+        # 语义召回兜底：结构化过滤 + 模糊匹配都落空时，用嵌入近邻补召回，
+        # 并与结构化过滤掩码求交，保证硬性条件仍然成立
+        if not results and intent == 'find_doctor':
+            sem_index = df_d.attrs.get('semantic_index')
+            if sem_index is not None:
+                try:
+                    q_emb = get_embedding_model().encode([query], normalize_embeddings=True)
+                    _, neighbors = sem_index.search(np.asarray(q_emb, dtype=np.float32), 20)
+                    hits = [i for i in neighbors[0] if i >= 0 and mask[i]]
+                    results = df_d.iloc[hits[:10]].to_dict('records')
+                except Exception as e:
+                    print(f"Semantic recall failed: {e}")
+
         return results, plan
     
-    def calculate_postal_distance(self, postal1, postal2):
-        """
-        计算新加坡邮政编码之间的距离
-        新加坡邮政编码分布规律：
-        - 前2位表示区域（01-99）
-        - 后4位表示具体位置
-        """
-        # 提取前2位区域代码
-        area1 = postal1 // 10000
-        area2 = postal2 // 10000
-        
-        # 如果在同一区域，使用后4位数字差距
-        if area1 == area2:
-            return abs(postal1 - postal2)
-        
-        # 不同区域的距离映射（基于新加坡地理位置）
-        area_distances = {
-            # Central (01-09) - 市中心区域
-            (1, 2): 1, (1, 3): 2, (1, 4): 3, (1, 5): 4, (1, 6): 5,
-            (1, 7): 6, (1, 8): 7, (1, 9): 8, (1, 10): 9,
-            
-            # North (72-73, 75-82) - 北部区域
-            (75, 76): 1, (75, 77): 2, (75, 78): 3, (75, 79): 4,
-            (79, 80): 1, (80, 81): 1, (81, 82): 1,
-            
-            # South (10-16) - 南部区域  
-            (10, 11): 1, (11, 12): 1, (12, 13): 1, (13, 14): 1,
-            (14, 15): 1, (15, 16): 1,
-            
-            # East (46-52) - 东部区域
-            (46, 47): 1, (47, 48): 1, (48, 49): 1, (49, 50): 1,
-            (50, 51): 1, (51, 52): 1,
-            
-            # West (60-69) - 西部区域
-            (60, 61): 1, (61, 62): 1, (62, 63): 1, (63, 64): 1,
-            (64, 65): 1, (65, 66): 1, (66, 67): 1, (67, 68): 1,
-            (68, 69): 1,
-            
-            # Northeast (53-59) - 东北部区域
-            (53, 54): 1, (54, 55): 1, (55, 56): 1, (56, 57): 1,
-            (57, 58): 1, (58, 59): 1,
-        }
-        
-        # 检查直接映射
-        area_pair = tuple(sorted([area1, area2]))
-        if area_pair in area_distances:
-            base_distance = area_distances[area_pair] * 10000
-        else:
-            # 默认跨区域距离
-            base_distance = abs(area1 - area2) * 10000
-        
-        # 加上区域内的细分距离
-        sub_distance = abs((postal1 % 10000) - (postal2 % 10000)) / 100
-        
-        return base_distance + sub_distance
-
     @st.cache_data(ttl=3600)
     def get_coordinates(_self, address, area=None):
-        """获取地址的坐标，使用缓存避免重复请求"""
+        """获取地址的坐标：内存缓存之外再落一层 SQLite，TTL 过期或重启后命中磁盘"""
+        cache_key = _coord_cache_key(address, area)
         try:
-            import re
-            
-            # 检查是否有特定邮政编码的精确坐标（移除641652让它使用普通geocoding）
-            postal_coordinates = {
-                '640526': (1.3486, 103.7065),  # Jurong West Street 61
-                # '641652': 移除特殊坐标，让它使用普通geocoding获得正确位置
-                '640652': (1.3500, 103.7070),  # Jurong West Street 65
-                '640650': (1.3495, 103.7068),  # Jurong West Street 65 附近
-                '640651': (1.3498, 103.7069),  # Jurong West Street 65 附近
-                '641650': (1.3390, 103.7120),  # Jurong West Street 64 附近
-                '641651': (1.3392, 103.7122),  # Jurong West Street 64 附近
-                '641653': (1.3398, 103.7128),  # Jurong West Street 64 附近
-            }
-            
-            # 从地址中提取邮政编码
+            row = _COORD_DB.execute('SELECT lat, lng FROM coords WHERE k=?', (cache_key,)).fetchone()
+            if row:
+                return row
+        except Exception as e:
+            print(f"Coord cache read error: {e}")
+
+        coords = _self._resolve_coordinates(address, area)
+        if coords:
+            try:
+                with _COORD_DB:
+                    _COORD_DB.execute('INSERT OR REPLACE INTO coords(k, lat, lng) VALUES (?, ?, ?)',
+                                      (cache_key, coords[0], coords[1]))
+            except Exception as e:
+                print(f"Coord cache write error: {e}")
+        return coords
+
+    def _resolve_coordinates(self, address, area=None):
+        """真正调用 geocoder 的路径，仅在两级缓存都未命中时执行"""
+        try:
+            # 从地址中提取邮政编码，检查是否有精确坐标
             postal_match = re.search(r'Singapore\s+(\d{6})', address)
             if postal_match:
                 postal_code = postal_match.group(1)
-                if postal_code in postal_coordinates:
-                    lat, lng = postal_coordinates[postal_code]
+                if postal_code in _PRECISE_POSTAL_COORDS:
+                    lat, lng = _PRECISE_POSTAL_COORDS[postal_code]
                     print(f"Using precise coordinates for postal code {postal_code}: {lat:.6f}, {lng:.6f}")
                     return lat, lng
             
-            geolocator = Nominatim(user_agent="medical_search_app")
+            geolocator = _GEOLOCATOR  # 复用模块级持久连接，不再每次新建
             
             # 清理地址：移除换行符和多余空格
             clean_address = address.replace('\n', ' ').replace('  ', ' ').strip()
             
             # 尝试1: 使用清理后的完整地址
+            _throttle_geocode()
             location = geolocator.geocode(f"{clean_address}", timeout=5)
             if location:
                 print(f"Geocoded address: {clean_address} -> {location.latitude:.6f}, {location.longitude:.6f}")
                 return location.latitude, location.longitude
             
             # 尝试2: 提取街道地址（去掉单元号）
-            import re
             postal_match = re.search(r'(\d+\s+[\w\s]+Street\s+\d+)', clean_address)
             if postal_match:
                 street_address = postal_match.group(1) + ', Singapore'
-                time.sleep(0.5)
+                _throttle_geocode()
                 location = geolocator.geocode(street_address, timeout=5)
                 if location:
                     print(f"Geocoded street: {street_address} -> {location.latitude:.6f}, {location.longitude:.6f}")
@@ -595,7 +1013,7 @@ class MedicalAgent:
             
             # 尝试3: 如果有区域信息，使用区域名称
             if area:
-                time.sleep(0.5)  # 避免API限制
+                _throttle_geocode()
                 location = geolocator.geocode(f"{area}, Singapore", timeout=5)
                 if location:
                     print(f"Geocoded area: {area} -> {location.latitude:.6f}, {location.longitude:.6f}")
@@ -603,24 +1021,7 @@ class MedicalAgent:
             
             # 尝试4: 使用更精确的区域坐标映射作为fallback
             if area:
-                area_coords = {
-                    'Jurong West': (1.347, 103.717),  # 更新为更准确的坐标
-                    'Bedok': (1.324, 103.930),
-                    'Tampines': (1.345, 103.944),
-                    'Yishun': (1.429, 103.835),
-                    'Woodlands': (1.437, 103.786),
-                    'Ang Mo Kio': (1.375, 103.845),
-                    'Sengkang': (1.391, 103.895),
-                    'Punggol': (1.405, 103.902),
-                    'Serangoon': (1.357, 103.874),
-                    'Bukit Batok': (1.358, 103.754),
-                    'Bukit Merah': (1.277, 103.823),
-                    'Clementi': (1.315, 103.760),
-                    'Hougang': (1.371, 103.886),
-                    'Pasir Ris': (1.372, 103.949),
-                    'Toa Payoh': (1.334, 103.856)
-                }
-                coords = area_coords.get(area)
+                coords = _GEOCODE_AREA_COORDS.get(area)
                 if coords:
                     print(f"Using fallback coordinates for {area}: {coords}")  # 调试信息
                 return coords
@@ -630,146 +1031,397 @@ class MedicalAgent:
         return None
     
     def create_map(self, clinic_results, query_postal=None):
-        """创建显示诊所位置的交互式地图"""
-        # 新加坡中心坐标
-        singapore_center = [1.3521, 103.8198]
-        
-        # 创建地图
-        m = folium.Map(
-            location=singapore_center,
-            zoom_start=11,
-            tiles='OpenStreetMap'
+        """创建显示诊所位置的交互式地图（按结果集整体缓存，历史回放时零重建）"""
+        return _build_map(_freeze_clinics(clinic_results), query_postal, self)
+
+    def create_deck(self, clinic_results, query_postal=None):
+        """pydeck 渲染路径：标记数据表按结果集缓存，前端 WebGL 实例化绘制"""
+        df = _build_deck_data(_freeze_clinics(clinic_results), query_postal, self)
+        if len(df):
+            center_lat, center_lng = float(df['lat'].mean()), float(df['lng'].mean())
+        else:
+            center_lat, center_lng = 1.3521, 103.8198
+        layer = pdk.Layer(
+            'ScatterplotLayer', data=df,
+            get_position='[lng, lat]', get_fill_color='color',
+            get_radius=150, pickable=True, stroked=True,
+            get_line_color=[255, 255, 255], line_width_min_pixels=1,
         )
-        
-        # 如果有查询邮政编码，尝试添加查询位置标记
-        if query_postal:
-            # 更精确的邮政编码到坐标映射（与fallback坐标一致）
-            postal_coords = {
-                'Jurong West': [1.347, 103.717],  # 更新为更准确的坐标
-                'Bedok': [1.324, 103.930],
-                'Tampines': [1.345, 103.944],
-                'Yishun': [1.429, 103.835],
-                'Woodlands': [1.437, 103.786],
-                'Ang Mo Kio': [1.375, 103.845],
-                'Sengkang': [1.391, 103.895],
-                'Punggol': [1.405, 103.902],
-                'Serangoon': [1.357, 103.874],
-                'Bukit Batok': [1.358, 103.754],
-                'Pasir Ris': [1.372, 103.949]
-            }
-            
-            # 直接获取查询邮政编码的精确坐标
+        return pdk.Deck(
+            layers=[layer],
+            initial_view_state=pdk.ViewState(latitude=center_lat, longitude=center_lng, zoom=12),
+            tooltip={'html': '{tooltip_html}'},
+        )
+
+def _freeze_clinics(clinic_results):
+    """结果列表冻结为可哈希元组：两条地图路径共用的缓存键"""
+    return tuple(
+        (str(c.get('Name', 'Unknown')), str(c.get('Area', '')),
+         str(c.get('Address', '')),
+         str(c.get('Contact') or c.get('Clinic Contact') or ''),
+         c.get('_distance'), str(c.get('_popup_html', '') or ''))
+        for c in clinic_results[:10]
+    )
+
+# 标记数据表的列序 (SoA)：与 _freeze_clinics 产出的元组字段一一对应
+_MARKER_COLS = ('name', 'area', 'address', 'contact', 'distance', 'popup')
+
+
+def _clinics_from_tuple(clinics_tuple):
+    """冻结元组还原为列式 DataFrame (AoS -> SoA)：循环一律走 itertuples
+    属性访问，不再每行每字段做一次字典哈希查找"""
+    return pd.DataFrame(list(clinics_tuple), columns=_MARKER_COLS)
+
+
+def _resolve_marker_coords(clinic_df, agent):
+    """为每个诊所解析标记坐标：批量预取 -> 两级缓存 -> 区域坐标加偏移 -> 全岛中心"""
+    # 批量预取：只收集精确邮编表和 SQLite 缓存都未覆盖的地址，一次异步批量请求，
+    # 循环内直接按下标查表；已缓存的地址走 get_coordinates 零网络命中。
+    # 批量失败时 results_by_index 为空，循环内自动退回 get_coordinates / 区域坐标路径
+    results_by_index = {}
+    if len(clinic_df):
+        pending = []
+        for i, (addr, area) in enumerate(zip(clinic_df['address'].tolist(),
+                                             clinic_df['area'].tolist())):
+            if not addr:
+                continue
+            clean = str(addr).replace('\n', ' ').strip()
+            postal_match = re.search(r'Singapore\s+(\d{6})', clean)
+            if postal_match and postal_match.group(1) in _PRECISE_POSTAL_COORDS:
+                continue  # 人工校准坐标优先，不让 Nominatim 结果覆盖
+            cache_key = _coord_cache_key(addr, area)
             try:
-                query_coords = self.get_coordinates(f"Singapore {query_postal}")
-                if query_coords:
-                    folium.Marker(
-                        query_coords,
-                        popup=f"📍 查询位置 (邮政编码: {query_postal})",
-                        icon=folium.Icon(color='red', icon='search')
-                    ).add_to(m)
-                    print(f"Added query marker for postal code {query_postal} at {query_coords}")
-                else:
-                    # fallback: 根据最近的诊所推断查询位置
-                    if clinic_results and len(clinic_results) > 0:
-                        first_clinic_area = clinic_results[0].get('Area', '')
-                        if first_clinic_area in postal_coords:
-                            query_coords = postal_coords[first_clinic_area]
-                            folium.Marker(
-                                query_coords,
-                                popup=f"📍 查询位置 (邮政编码: {query_postal})",
-                                icon=folium.Icon(color='red', icon='search')
-                            ).add_to(m)
-                            print(f"Added fallback query marker for {query_postal} in {first_clinic_area}")
+                if _COORD_DB.execute('SELECT 1 FROM coords WHERE k=?', (cache_key,)).fetchone():
+                    continue  # 磁盘缓存已有坐标，不必重打 API
             except Exception as e:
-                print(f"Error adding query location marker: {e}")
-        
-        # 添加诊所标记
-        for i, clinic in enumerate(clinic_results[:10]):  # 最多显示10个诊所
-            address = clinic.get('Address', '')
-            name = clinic.get('Name', 'Unknown')
-            area = clinic.get('Area', '')
-            contact = clinic.get('Contact', clinic.get('Clinic Contact', ''))
-            distance = clinic.get('_distance', '')
-            
-            # 定义区域fallback坐标
-            area_fallback_coords = {
-                'Bedok': (1.324, 103.930),
-                'Tampines': (1.345, 103.944),
-                'Jurong West': (1.347, 103.717),
-                'Woodlands': (1.437, 103.786),
-                'Yishun': (1.429, 103.835),
-                'Ang Mo Kio': (1.375, 103.845),
-                'Hougang': (1.361, 103.886),
-                'Sengkang': (1.391, 103.895),
-                'Punggol': (1.405, 103.902),
-                'Serangoon': (1.357, 103.874),
-                'Bukit Batok': (1.358, 103.754),
-                'Pasir Ris': (1.372, 103.949),
-                'Toa Payoh': (1.334, 103.848),
-                'Bishan': (1.351, 103.848),
-                'Kallang': (1.311, 103.862),
-            }
-            
-            # 尝试获取精确坐标，fallback到区域坐标加小偏移
-            coords = self.get_coordinates(address, area)
-            
-            if coords:
-                coord_source = "Geocoded"
-                print(f"Clinic {i+1} ({name}): Geocoded {coords} - {coord_source}")
-            else:
-                # 使用区域坐标但添加小偏移，让每个诊所显示在不同位置
-                if area in area_fallback_coords:
-                    base_lat, base_lng = area_fallback_coords[area]
-                    # 添加小的随机偏移（0.001-0.005度，约100-500米）
-                    import random
-                    random.seed(hash(name) % 1000)  # 使用诊所名称作为种子，确保一致性
-                    offset_lat = (random.random() - 0.5) * 0.01  # ±0.005度偏移
-                    offset_lng = (random.random() - 0.5) * 0.01
-                    coords = (base_lat + offset_lat, base_lng + offset_lng)
-                    coord_source = f"Area-{area}-Offset"
-                    print(f"Clinic {i+1} ({name}): Using area coordinates with offset {coords} - {coord_source}")
-                else:
-                    # 最后fallback到新加坡中心
-                    coords = (1.3521, 103.8198)
-                    coord_source = "Singapore-Center"
-                    print(f"Clinic {i+1} ({name}): Using Singapore center {coords} - {coord_source}")
-            
-            # 确保总是有坐标
-            if coords:
-                lat, lng = coords
-                
-                # 创建弹出信息
-                popup_html = f"""
-                <div style='font-family: Arial, sans-serif; width: 250px;'>
-                    <h4 style='margin: 0 0 10px 0; color: #2E8B57;'>🏥 {name}</h4>
-                    <p style='margin: 5px 0;'><strong>📍 区域:</strong> {area}</p>
-                    <p style='margin: 5px 0;'><strong>🏠 地址:</strong> {address}</p>
-                    <p style='margin: 5px 0;'><strong>📞 电话:</strong> {contact}</p>
-                    {f'<p style="margin: 5px 0;"><strong>📏 距离:</strong> {distance}</p>' if distance else ''}
-                </div>
-                """
-                
-                # 简化颜色判断逻辑
-                if distance:
-                    if distance <= 2000:  # 近距离
-                        color = 'green'
-                    else:  # 远距离
-                        color = 'orange'
-                else:
-                    color = 'gray'  # 没有距离信息
-                
-                # 添加标记
+                print(f"Coord cache read error: {e}")
+            pending.append((i, clean, cache_key))
+        if HAS_AIOHTTP and pending:
+            try:
+                locs = geocode_batch([addr for _, addr, _ in pending])
+                for (i, _, cache_key), loc in zip(pending, locs):
+                    if loc:
+                        results_by_index[i] = (loc.latitude, loc.longitude)
+                        try:
+                            # 批量结果同样落盘，下次直接命中缓存
+                            with _COORD_DB:
+                                _COORD_DB.execute(
+                                    'INSERT OR REPLACE INTO coords(k, lat, lng) VALUES (?, ?, ?)',
+                                    (cache_key, loc.latitude, loc.longitude))
+                        except Exception as e:
+                            print(f"Coord cache write error: {e}")
+            except Exception as e:
+                print(f"Batch geocoding prefetch failed: {e}")
+
+    coords_list = []
+    for i, row in enumerate(clinic_df.itertuples(index=False)):
+        # 尝试获取精确坐标（优先用批量预取结果），fallback到区域坐标加小偏移
+        coords = results_by_index.get(i) or agent.get_coordinates(row.address, row.area)
+        if coords:
+            print(f"Clinic {i+1} ({row.name}): Geocoded {coords} - Geocoded")
+        elif row.area in _AREA_FALLBACK_COORDS:
+            # 使用区域坐标但添加小偏移，让每个诊所显示在不同位置。
+            # 由诊所名的 crc32 直接算出 ±0.005 度偏移（约 ±500 米）：
+            # 跨进程稳定（hash() 受 PYTHONHASHSEED 影响），也省掉重播种全局 PRNG
+            base_lat, base_lng = _AREA_FALLBACK_COORDS[row.area]
+            h = zlib.crc32(row.name.encode())
+            offset_lat = ((h & 0xFFFF) / 65535.0 - 0.5) * 0.01
+            offset_lng = (((h >> 16) & 0xFFFF) / 65535.0 - 0.5) * 0.01
+            coords = (base_lat + offset_lat, base_lng + offset_lng)
+            print(f"Clinic {i+1} ({row.name}): Using area coordinates with offset {coords} - Area-{row.area}-Offset")
+        else:
+            # 最后fallback到新加坡中心
+            coords = (1.3521, 103.8198)
+            print(f"Clinic {i+1} ({row.name}): Using Singapore center {coords} - Singapore-Center")
+        coords_list.append(coords)
+    return coords_list
+
+
+def _popup_for(row):
+    """弹窗/悬浮 HTML：优先用载入时预渲染的静态部分，只补距离行；
+    没有预渲染（如手工构造的结果）时再做完整模板替换"""
+    distance_row = (f'<p style="margin: 5px 0;"><strong>📏 距离:</strong> {row.distance}</p>'
+                    if row.distance else '')
+    if row.popup:
+        return row.popup.replace('$distance_row', distance_row)
+    return _POPUP_TMPL.substitute(
+        name=html.escape(str(row.name)),
+        area=html.escape(str(row.area)),
+        address=html.escape(str(row.address)),
+        contact=html.escape(str(row.contact)),
+        distance_row=distance_row,
+    )
+
+
+def _marker_colors(clinic_df):
+    """标记颜色一次性向量化分类：无距离 (空/0) -> gray，<=2000 -> green，否则 orange"""
+    dists = pd.to_numeric(clinic_df['distance'], errors='coerce').to_numpy(dtype=np.float64)
+    no_dist = np.isnan(dists) | (dists == 0)
+    return np.where(no_dist, 'gray', np.where(dists <= 2000, 'green', 'orange'))
+
+
+@st.cache_data(max_entries=64, show_spinner=False)
+def _build_map(clinics_tuple, query_postal, _agent):
+    """按冻结的诊所元组构建 Folium 地图；_agent 带下划线不参与缓存键"""
+    # 延迟导入：folium + branca + jinja2 占数百毫秒冷启动，只有真正走
+    # Folium 后备路径才加载（pydeck 可用或纯医生搜索的会话完全不 import）
+    import folium
+
+    clinic_df = _clinics_from_tuple(clinics_tuple)
+
+    # 新加坡中心坐标
+    singapore_center = [1.3521, 103.8198]
+
+    # 创建地图
+    m = folium.Map(
+        location=singapore_center,
+        zoom_start=11,
+        tiles='OpenStreetMap'
+    )
+
+    coords_list = _resolve_marker_coords(clinic_df, _agent)
+    colors = _marker_colors(clinic_df)
+
+    # 如果有查询邮政编码，尝试添加查询位置标记
+    if query_postal:
+        # 直接获取查询邮政编码的精确坐标
+        try:
+            query_coords = _agent.get_coordinates(f"Singapore {query_postal}")
+            if query_coords:
                 folium.Marker(
-                    [lat, lng],
-                    popup=folium.Popup(popup_html, max_width=300),
-                    tooltip=f"{i+1}. {name}",
-                    icon=folium.Icon(color=color, icon='plus-sign')
+                    query_coords,
+                    popup=f"📍 查询位置 (邮政编码: {query_postal})",
+                    icon=folium.Icon(color='red', icon='search')
                 ).add_to(m)
+                print(f"Added query marker for postal code {query_postal} at {query_coords}")
+            else:
+                # fallback: 根据最近的诊所推断查询位置
+                if len(clinic_df) > 0:
+                    first_clinic_area = clinic_df['area'].iloc[0]
+                    if first_clinic_area in _QUERY_AREA_COORDS:
+                        query_coords = _QUERY_AREA_COORDS[first_clinic_area]
+                        folium.Marker(
+                            query_coords,
+                            popup=f"📍 查询位置 (邮政编码: {query_postal})",
+                            icon=folium.Icon(color='red', icon='search')
+                        ).add_to(m)
+                        print(f"Added fallback query marker for {query_postal} in {first_clinic_area}")
+        except Exception as e:
+            print(f"Error adding query location marker: {e}")
+    
+    # 添加诊所标记：整批组成一个 GeoJSON FeatureCollection，单次 add_to 挂载，
+    # Python 侧不再构造 N 个 Marker 对象，前端由 Leaflet 从一份 JSON 实例化
+    features = []
+    for i, row in enumerate(clinic_df.itertuples(index=False)):  # 最多显示10个诊所 (冻结时已截断)
+        lat, lng = coords_list[i]
+        features.append({
+            'type': 'Feature',
+            'geometry': {'type': 'Point', 'coordinates': [lng, lat]},
+            'properties': {
+                'label': f"{i+1}. {row.name}",
+                'popup': _popup_for(row),
+                'color': str(colors[i]),
+            },
+        })
+    if features:
+        folium.GeoJson(
+            {'type': 'FeatureCollection', 'features': features},
+            marker=folium.CircleMarker(radius=8, fill=True, fill_opacity=0.9,
+                                       weight=1, color='white'),
+            style_function=_geojson_marker_style,
+            tooltip=folium.GeoJsonTooltip(fields=['label'], labels=False),
+            popup=folium.GeoJsonPopup(fields=['popup'], labels=False, max_width=300),
+        ).add_to(m)
+    return m
+
+
+def _geojson_marker_style(feature):
+    """GeoJson 标记着色：颜色在 properties 里预计算（具名函数保证地图对象可 pickle 缓存）"""
+    return {'fillColor': feature['properties']['color']}
+
+
+# pydeck 的颜色映射 (RGBA)：与 Folium 图例口径一致
+_DECK_COLORS = MappingProxyType({
+    'green': [46, 139, 87, 200],
+    'orange': [255, 140, 0, 200],
+    'gray': [128, 128, 128, 200],
+    'red': [220, 20, 60, 230],
+})
+
+
+@st.cache_data(max_entries=64, show_spinner=False)
+def _build_deck_data(clinics_tuple, query_postal, _agent):
+    """pydeck 标记数据表：坐标解析与颜色分类和 Folium 路径完全同源"""
+    clinic_df = _clinics_from_tuple(clinics_tuple)
+    coords_list = _resolve_marker_coords(clinic_df, _agent)
+    colors = _marker_colors(clinic_df)
+
+    rows = []
+    for i, row in enumerate(clinic_df.itertuples(index=False)):
+        lat, lng = coords_list[i]
+        rows.append({
+            'lat': lat, 'lng': lng,
+            'color': list(_DECK_COLORS[str(colors[i])]),
+            'tooltip_html': _popup_for(row),
+        })
+
+    # 查询位置标记（红色）：精确坐标失败时退回第一家诊所的区域坐标
+    if query_postal:
+        try:
+            query_coords = _agent.get_coordinates(f"Singapore {query_postal}")
+            if not query_coords and len(clinic_df):
+                query_coords = _QUERY_AREA_COORDS.get(clinic_df['area'].iloc[0])
+            if query_coords:
+                rows.append({
+                    'lat': query_coords[0], 'lng': query_coords[1],
+                    'color': list(_DECK_COLORS['red']),
+                    'tooltip_html': f"📍 查询位置 (邮政编码: {query_postal})",
+                })
+        except Exception as e:
+            print(f"Error adding query location marker: {e}")
+
+    return pd.DataFrame(rows, columns=['lat', 'lng', 'color', 'tooltip_html'])
+
+@st.fragment
+def _render_chat(agent, df_c, df_d):
+    """聊天历史与输入区：整体作为 fragment，新查询只重跑本区域而非整个脚本，
+    侧边栏、文件上传与数据加载都不再被每次聊天触发"""
+    if "history" not in st.session_state:
+        st.session_state.history = []
+
+    for idx, (q, r_list, plan) in enumerate(st.session_state.history):
+        # 只有最新一轮挂载交互式地图：历史轮的 Leaflet 组件重挂载开销大且很少被用到
+        is_latest = idx == len(st.session_state.history) - 1
+        with st.chat_message("user"): st.write(q)
+        with st.chat_message("assistant"):
+            # 展示思考过程
+            with st.expander("🧠 Agent 思考过程 (JSON)"):
+                st.json(plan)
+           
+            if not r_list:
+                st.warning("未找到匹配结果。")
+            else:
+                st.write(f"🔍 找到 {len(r_list)} 个结果:")
                 
-                # 添加延迟避免API限制
-                time.sleep(0.1)
-        
-        return m
+                # 检查是否为诊所搜索且有结果，显示地图
+                is_clinic_search = not (r_list and r_list[0].get('Specialty'))  # 没有Specialty字段说明是诊所
+                show_map = is_latest or st.session_state.get('_map_turn') == idx
+                if is_clinic_search and len(r_list) > 0 and not show_map:
+                    # 历史轮默认不重挂地图，点按钮后仅为该轮重新挂载
+                    if st.button("🗺️ 重新显示该轮的诊所地图", key=f"show_map_{idx}"):
+                        st.session_state['_map_turn'] = idx
+                        st.rerun()
+                if is_clinic_search and len(r_list) > 0 and show_map:
+                    with st.expander("🗺️ 在地图上查看诊所位置", expanded=True):
+                        # 获取查询邮政编码（如果有）：字典链只取一次，再判断是否为纯数字
+                        area_val = (plan.get('filters') or {}).get('Area', '')
+                        query_postal = area_val if area_val.isdigit() else None
+                        
+                        # 创建并显示地图：优先 pydeck (WebGL，单份 JSON 数据、
+                        # 无 Leaflet 重挂载)，不可用时退回 Folium + st_folium
+                        with st.spinner("正在获取诊所坐标并生成地图..."):
+                            if HAS_PYDECK:
+                                st.pydeck_chart(agent.create_deck(r_list[:10], query_postal))
+                                st.caption("🟢 近距离　🟠 远距离　⚪ 未知距离　🔴 查询位置")
+                            else:
+                                # Folium 后备路径按需导入，见 _build_map 的说明
+                                import folium
+                                from streamlit_folium import st_folium
+
+                                clinic_map = agent.create_map(r_list[:10], query_postal)
+
+                                # 添加简化图例
+                                legend_html = '''
+                                <div style="position: fixed;
+                                            top: 10px; right: 10px; width: 150px; height: auto;
+                                            background-color: white; border:2px solid grey; z-index:9999;
+                                            font-size:12px; padding: 8px">
+                                <h4 style="margin-top:0; margin-bottom:8px;">图例</h4>
+                                <p style="margin:3px 0;"><i class="fa fa-search" style="color:red"></i> 查询位置</p>
+                                <p style="margin:3px 0;"><i class="fa fa-circle" style="color:green"></i> 近距离</p>
+                                <p style="margin:3px 0;"><i class="fa fa-circle" style="color:orange"></i> 远距离</p>
+                                <p style="margin:3px 0;"><i class="fa fa-circle" style="color:gray"></i> 未知距离</p>
+                                </div>
+                                '''
+                                clinic_map.get_root().html.add_child(folium.Element(legend_html))
+
+                                st_folium(clinic_map, width=700, height=500)
+                        
+                        # 简化的地图说明
+                        st.info("🗺️ **地图使用提示：** 点击任意标记查看诊所详细信息。右上角图例显示距离远近颜色说明。")
+                
+                for row in r_list:
+                    # 智能判断是医生还是诊所数据
+                    if 'Specialty' in row and row.get('Specialty'):
+                        # 医生信息展示
+                        name = row.get('Name', 'Unknown')
+                        spec = row.get('Specialty', '')
+                        lang = row.get('Languages', '')
+                        svcs = row.get('Services', '')
+                       
+                        st.markdown(f"""
+                        <div class="result-card">
+                            <div style="font-size:1.2em; font-weight:bold;">👨‍⚕️ {name}</div>
+                            <div class="tag-container">
+                                {f'<span class="tag tag-spec">{spec}</span>' if spec else ''}
+                                {f'<span class="tag tag-lang">🗣️ {lang}</span>' if lang else ''}
+                            </div>
+                            <div style="margin-top:10px; font-size:0.9em; color:#555;">
+                                {f'🛠️ <b>服务:</b> {svcs}' if svcs else ''}
+                            </div>
+                        </div>
+                        """, unsafe_allow_html=True)
+                    else:
+                        # 诊所信息展示
+                        name = row.get('Name', 'Unknown')
+                        area = row.get('Area', '')
+                        address = row.get('Address', '')
+                        contact = row.get('Contact') or row.get('Clinic Contact') or ''
+                        
+                        # 格式化地址显示 - 去标签后 split/join 归一空白，再转义
+                        if address:
+                            address_clean = ' '.join(_HTML_TAG_RE.sub('', address).split())
+                            address_display = html.escape(address_clean)
+                        else:
+                            address_display = ''
+                        
+                        # 计算距离信息（使用预计算的距离）
+                        distance_info = ''
+                        if '_distance' in row and row['_distance'] is not None:
+                            distance = int(row['_distance'])
+                            distance_info = f'📏 <b>距离:</b> {distance} (邮政编码差值)<br>'
+                        
+                        st.markdown(f"""
+<div class="result-card">
+<div style="font-size:1.2em; font-weight:bold;">🏥 {name}</div>
+<div class="tag-container">
+{f'<span class="tag tag-loc">📍 {area}</span>' if area else ''}
+</div>
+<div style="margin-top:10px; font-size:0.9em; color:#555;">
+{distance_info}
+{f'🏠 <b>地址:</b> {address_display}' if address else ''}
+{('<br>' if address and contact else '') + (f'📞 <b>电话:</b> {contact}' if contact else '')}
+</div>
+</div>
+""", unsafe_allow_html=True)
+
+    # 输入处理
+    query = st.chat_input("请输入查询 (如: 'Find dr. Low Huey Moon', 或 'clinic nearest 179094')")
+    if query:
+        if not agent.client:
+            st.error("请先在左侧输入 API Key")
+        else:
+            # 记录用户提问
+            st.session_state.history.append((query, [], {})) # 占位
+           
+            # 执行搜索
+            with st.spinner("小助手正在思考中..."):
+                results, plan = agent.search(df_c, df_d, query)
+               
+                # 更新历史记录
+                st.session_state.history[-1] = (query, results, plan)
+                st.rerun(scope="fragment")  # 只重跑聊天区域显示结果
+
 
 def main():
     agent = MedicalAgent()
@@ -799,131 +1451,7 @@ def main():
        
         # 聊天交互区 - 只在数据加载成功时显示
         if df_c is not None and df_d is not None:
-            if "history" not in st.session_state:
-                st.session_state.history = []
-
-            for q, r_list, plan in st.session_state.history:
-                with st.chat_message("user"): st.write(q)
-                with st.chat_message("assistant"):
-                    # 展示思考过程
-                    with st.expander("🧠 Agent 思考过程 (JSON)"):
-                        st.json(plan)
-                   
-                    if not r_list:
-                        st.warning("未找到匹配结果。")
-                    else:
-                        st.write(f"🔍 找到 {len(r_list)} 个结果:")
-                        
-                        # 检查是否为诊所搜索且有结果，显示地图
-                        is_clinic_search = not (r_list and r_list[0].get('Specialty'))  # 没有Specialty字段说明是诊所
-                        if is_clinic_search and len(r_list) > 0:
-                            with st.expander("🗺️ 在地图上查看诊所位置", expanded=True):
-                                # 获取查询邮政编码（如果有）
-                                query_postal = plan.get('filters', {}).get('Area', '') if plan.get('filters', {}).get('Area', '').isdigit() else None
-                                
-                                # 创建并显示地图
-                                with st.spinner("正在获取诊所坐标并生成地图..."):
-                                    clinic_map = agent.create_map(r_list[:10], query_postal)
-                                    
-                                    # 添加简化图例
-                                    legend_html = '''
-                                    <div style="position: fixed; 
-                                                top: 10px; right: 10px; width: 150px; height: auto; 
-                                                background-color: white; border:2px solid grey; z-index:9999; 
-                                                font-size:12px; padding: 8px">
-                                    <h4 style="margin-top:0; margin-bottom:8px;">图例</h4>
-                                    <p style="margin:3px 0;"><i class="fa fa-search" style="color:red"></i> 查询位置</p>
-                                    <p style="margin:3px 0;"><i class="fa fa-circle" style="color:green"></i> 近距离</p>
-                                    <p style="margin:3px 0;"><i class="fa fa-circle" style="color:orange"></i> 远距离</p>
-                                    <p style="margin:3px 0;"><i class="fa fa-circle" style="color:gray"></i> 未知距离</p>
-                                    </div>
-                                    '''
-                                    clinic_map.get_root().html.add_child(folium.Element(legend_html))
-                                    
-                                    st_folium(clinic_map, width=700, height=500)
-                                
-                                # 简化的地图说明
-                                st.info("🗺️ **地图使用提示：** 点击任意标记查看诊所详细信息。右上角图例显示距离远近颜色说明。")
-                        
-                        for row in r_list:
-                            # 智能判断是医生还是诊所数据
-                            if 'Specialty' in row and row.get('Specialty'):
-                                # 医生信息展示
-                                name = row.get('Name', 'Unknown')
-                                spec = row.get('Specialty', '')
-                                lang = row.get('Languages', '')
-                                svcs = row.get('Services', '')
-                               
-                                st.markdown(f"""
-                                <div class="result-card">
-                                    <div style="font-size:1.2em; font-weight:bold;">👨‍⚕️ {name}</div>
-                                    <div class="tag-container">
-                                        {f'<span class="tag tag-spec">{spec}</span>' if spec else ''}
-                                        {f'<span class="tag tag-lang">🗣️ {lang}</span>' if lang else ''}
-                                    </div>
-                                    <div style="margin-top:10px; font-size:0.9em; color:#555;">
-                                        {f'🛠️ <b>服务:</b> {svcs}' if svcs else ''}
-                                    </div>
-                                </div>
-                                """, unsafe_allow_html=True)
-                            else:
-                                # 诊所信息展示
-                                name = row.get('Name', 'Unknown')
-                                area = row.get('Area', '')
-                                address = row.get('Address', '')
-                                contact = row.get('Contact', row.get('Clinic Contact', ''))
-                                
-                                # 格式化地址显示 - 彻底清理所有特殊字符
-                                import re
-                                if address:
-                                    # 移除所有HTML标签
-                                    address_clean = re.sub(r'<[^>]*>', '', address)
-                                    # 移除换行符、制表符等特殊字符
-                                    address_clean = re.sub(r'[\n\r\t]+', ' ', address_clean)
-                                    # 合并多个空格
-                                    address_clean = re.sub(r'\s+', ' ', address_clean)
-                                    # HTML转义，防止特殊字符影响显示
-                                    import html
-                                    address_display = html.escape(address_clean.strip())
-                                else:
-                                    address_display = ''
-                                
-                                # 计算距离信息（使用预计算的距离）
-                                distance_info = ''
-                                if '_distance' in row and row['_distance'] is not None:
-                                    distance = int(row['_distance'])
-                                    distance_info = f'📏 <b>距离:</b> {distance} (邮政编码差值)<br>'
-                                
-                                st.markdown(f"""
-<div class="result-card">
-<div style="font-size:1.2em; font-weight:bold;">🏥 {name}</div>
-<div class="tag-container">
-{f'<span class="tag tag-loc">📍 {area}</span>' if area else ''}
-</div>
-<div style="margin-top:10px; font-size:0.9em; color:#555;">
-{distance_info}
-{f'🏠 <b>地址:</b> {address_display}' if address else ''}
-{('<br>' if address and contact else '') + (f'📞 <b>电话:</b> {contact}' if contact else '')}
-</div>
-</div>
-""", unsafe_allow_html=True)
-
-            # 输入处理
-            query = st.chat_input("请输入查询 (如: 'Find dr. Low Huey Moon', 或 'clinic nearest 179094')")
-            if query:
-                if not agent.client:
-                    st.error("请先在左侧输入 API Key")
-                else:
-                    # 记录用户提问
-                    st.session_state.history.append((query, [], {})) # 占位
-                   
-                    # 执行搜索
-                    with st.spinner("小助手正在思考中..."):
-                        results, plan = agent.search(df_c, df_d, query)
-                       
-                        # 更新历史记录
-                        st.session_state.history[-1] = (query, results, plan)
-                        st.rerun() # 刷新页面显示结果
+            _render_chat(agent, df_c, df_d)
         else:
             st.warning("请上传诊所和医生数据文件后再开始搜索")
 